@@ -71,18 +71,35 @@
 
 import sys
 import os.path
-from subprocess import Popen, PIPE
+import io
+import re
+from string import Template
+from subprocess import Popen, PIPE, check_output
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.nonmultipart import MIMENonMultipart
-from email.header import Header
 from email.utils import formataddr, parseaddr
-from email import encoders
 import email.utils
 import smtplib
+import base64
+import gzip
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
 from configparser import ConfigParser
 import requests
 
+# The object id git uses to indicate that a ref didn't exist before, or
+# doesn't exist after, the push.
+NULL_SHA = "0" * 40
+
+# Namespaces of the refs for branches and tags
+REFS_HEADS = "refs/heads/"
+REFS_TAGS = "refs/tags/"
+
 cfgname = "%s/commitmsg.ini" % os.path.dirname(sys.argv[0])
 if not os.path.isfile(cfgname):
     raise Exception("Config file '%s' is missing!" % cfgname)
@@ -96,43 +113,89 @@ except Exception as e:
     print("Except: %s" % e)
     debug = True
 
-
-def should_send_message(msgtype):
-    """
-    Determine if a specific message type should be sent, by looking
-    in the ini file. Unless specifically disabled, all types are
-    sent.
-    """
+# Determine which types of message should be sent. Unless specifically
+# disabled, all types are sent.
+SENDMESSAGE = {}
+for msgtype in ('commit', 'tag', 'branch'):
     try:
-        sendit = int(c.get('commitmsg', '%smsg' % msgtype))
-        if sendit == 0:
-            return False
-        return True
-    except Exception as e:
-        return True
+        SENDMESSAGE[msgtype] = c.getboolean('commitmsg', '%smsg' % msgtype, fallback=True)
+    except ValueError:
+        SENDMESSAGE[msgtype] = True
+
+# All the other settings live in a single section, so pull them out of the
+# config parser into a read-only dict once, do all lookups in that, and
+# get rid of the parser.
+cfg = MappingProxyType(dict(c.items('commitmsg')))
+del c
+
+# Look up the config values that are used for every message once, instead
+# of going back to the config for each commit.
+if 'destination' in cfg:
+    DESTINATIONS = [d.strip() for d in cfg['destination'].split(',')]
+else:
+    DESTINATIONS = []
+FALLBACKSENDER = cfg.get('fallbacksender')
+SUBJECT = Template(cfg.get('subject', ''))
+if 'gitweb' in cfg:
+    GITWEB = Template(cfg['gitweb'])
+else:
+    GITWEB = None
+ATTACHARCHIVE = cfg.get('attacharchive') == '1'
+INCLUDEDIFF = cfg.get('includediff') == '1'
+if 'replyto' in cfg:
+    REPLYTO = [p.strip() for p in cfg['replyto'].split(',')]
+else:
+    REPLYTO = None
+FORCESENDERADDR = cfg.get('forcesenderaddr')
+FORCESENDERNAME = cfg.get('forcesendername')
+EXCLUDEBRANCHES = frozenset(b.strip() for b in cfg.get('excludebranches', '').split(',') if b.strip())
+if 'pingurl' in cfg:
+    PINGURLS = cfg['pingurl'].split(' ')
+else:
+    PINGURLS = []
+
+# If any of the ping URLs include the branch, we need to know which
+# branches the pushed commits are on even when no mail is sent.
+PINGBRANCHES = any('$branch' in pingurl for pingurl in PINGURLS)
+
+# Seconds to wait for a ping to connect, or between bytes of the response,
+# so an unresponsive server can't hang the push forever.
+PING_TIMEOUT = 10
+
+# Header lines that git log --pretty=full shows for each commit, matched
+# against the raw bytes so only the value has to be decoded
+LOG_HEADER_RE = re.compile(rb'(commit|Author:|Commit:|Merge:) (.*)')
 
 
 allmail = []
 allbranches = []
+pinglocal = threading.local()
+batchcheck = None
+headwalks = {}
 
 
+# Pushes usually contain many commits from the same few people, so only
+# encode each sender once.
+@lru_cache(maxsize=64)
 def reencode_mail_address(m):
     (name, email) = parseaddr(m)
 
     if name:
-        return formataddr((str(Header(name, 'utf-8')), email))
+        # formataddr only uses an RFC 2047 encoded word when the name
+        # actually contains non-ASCII characters, and just quotes it
+        # as needed otherwise.
+        return formataddr((name, email), charset='utf-8')
     else:
         return email
 
 
 def sendmail(text, sender, subject, archive=None):
-    if not c.has_option('commitmsg', 'destination'):
+    if not DESTINATIONS:
         return
 
-    if c.has_option('commitmsg', 'replyto'):
+    if REPLYTO:
         pieces = []
-        for p in c.get('commitmsg', 'replyto').split(','):
-            pp = p.strip()
+        for pp in REPLYTO:
             if pp == '$committer':
                 if sender:
                     pieces.append(sender.strip())
@@ -145,143 +208,319 @@ def sendmail(text, sender, subject, archive=None):
 
     if not sender:
         # No sender specified, so use fallback
-        sender = c.get('commitmsg', 'fallbacksender')
+        sender = FALLBACKSENDER
 
     (sender_name, sender_address) = email.utils.parseaddr(sender)
 
-    if c.has_option('commitmsg', 'forcesenderaddr'):
-        sender_address = c.get('commitmsg', 'forcesenderaddr')
+    if FORCESENDERADDR is not None:
+        sender_address = FORCESENDERADDR
 
-    if c.has_option('commitmsg', 'forcesendername'):
-        sender_name = c.get('commitmsg', 'forcesendername').replace('$committer', sender_name)
+    if FORCESENDERNAME is not None:
+        sender_name = FORCESENDERNAME.replace('$committer', sender_name)
 
     if sender_name:
         fullsender = "{0} <{1}>".format(sender_name, sender_address)
     else:
         fullsender = sender_address
 
-    for m in c.get('commitmsg', 'destination').split(','):
-        msg = MIMEMultipart()
-        msg['From'] = reencode_mail_address(fullsender)
-        msg['To'] = m
-        msg['Subject'] = subject
-        if replyto:
-            msg['Reply-To'] = replyto
-        msg['X-Auto-Response-Suppress'] = 'All'
-        msg['Auto-Submitted'] = 'auto-generated'
-
-        # Don't specify utf8 when doing debugging, because that will encode the output
-        # as base64 which is completely useless on the console...
-        if debug:
-            msg.attach(MIMEText(text))
-        else:
-            msg.attach(MIMEText(text, _charset='utf-8'))
+    # The contents are the same for all destinations, so only build the
+    # message once, and just change the recipient for each of them.
+    # Don't specify utf8 when doing debugging, because that will encode the output
+    # as base64 which is completely useless on the console...
+    if debug:
+        textpart = MIMEText(text)
+    else:
+        textpart = MIMEText(text, _charset='utf-8')
 
-        if archive:
-            part = MIMENonMultipart('application', 'x-gzip')
-            part.set_payload(archive)
-            part.add_header('Content-Disposition', 'attachment; filename="archive.tar.gz"')
-            encoders.encode_base64(part)
-            msg.attach(part)
+    if archive:
+        # Only wrap the text in a multipart message when there is actually
+        # something to attach to it.
+        archivepart = MIMENonMultipart('application', 'x-gzip')
+        archivepart.set_payload(archive)
+        archivepart.add_header('Content-Transfer-Encoding', 'base64')
+        archivepart.add_header('Content-Disposition', 'attachment; filename="archive.tar.gz"')
 
+        msg = MIMEMultipart()
+        msg.attach(textpart)
+        msg.attach(archivepart)
+    else:
+        msg = textpart
+
+    msg['From'] = reencode_mail_address(fullsender)
+    msg['To'] = DESTINATIONS[0]
+    msg['Subject'] = subject
+    if replyto:
+        msg['Reply-To'] = replyto
+    msg['X-Auto-Response-Suppress'] = 'All'
+    msg['Auto-Submitted'] = 'auto-generated'
+
+    for m in DESTINATIONS:
+        msg.replace_header('To', m)
         allmail.append({
             'sender': sender_address,
             'to': m,
-            'msg': msg,
+            'msg': msg.as_string(),
         })
 
 
 def flush_mail():
     """
-    Send off an email using the local sendmail binary.
+    Send off all queued emails through the local mailserver, using a
+    single SMTP connection for all of them.
     """
 
-    # Need to reverse list to make sure we send the emails out in the same
-    # order as the commits appeared. They'll usually go out at the same time
-    # anyway, but if they do get different timestamps, we want them in the
-    # correct order.
-    for msg in reversed(allmail):
-        if debug:
+    # The emails are queued in the same order as the commits appeared, and
+    # need to be sent out in that order. They'll usually go out at the same
+    # time anyway, but if they do get different timestamps, we want them in
+    # the correct order.
+    if debug:
+        for msg in allmail:
             print(msg['msg'])
+        return
+
+    if not allmail:
+        return
+
+    smtp = smtplib.SMTP("localhost")
+    try:
+        for msg in allmail:
+            data = msg['msg'].encode('utf8')
+            try:
+                smtp.sendmail(msg['sender'], msg['to'], data)
+            except smtplib.SMTPServerDisconnected:
+                # The server may drop a connection that has been used for
+                # many messages, so reconnect and try once more.
+                smtp.close()
+                smtp = smtplib.SMTP("localhost")
+                smtp.sendmail(msg['sender'], msg['to'], data)
+        smtp.quit()
+    finally:
+        smtp.close()
+
+
+def ping(pingurl):
+    """
+    Make a http POST to the specified URL, and return a list of lines
+    describing the result. Each thread keeps its own session, so pings
+    to the same server can share a keep-alive connection.
+    """
+    if not hasattr(pinglocal, 'session'):
+        pinglocal.session = requests.Session()
+
+    output = []
+    # Make a http POST (the empty content makes it a POST)
+    # We ignore what the result is, so we also ignore any exceptions.
+    try:
+        r = pinglocal.session.post(pingurl, timeout=PING_TIMEOUT)
+        if r.status_code == 200:
+            for l in r.text.splitlines():
+                output.append("PING: {0}".format(l))
         else:
-            smtp = smtplib.SMTP("localhost")
-            smtp.sendmail(msg['sender'], msg['to'], msg['msg'].as_string().encode('utf8'))
-            smtp.close()
+            output.append("ERROR: status {0} {1} from ping!".format(r.status_code, r.reason))
+            if r.headers['content-type'].split(';')[0] == 'text/plain':
+                for l in r.text.splitlines():
+                    output.append("ERROR: {0}".format(l))
+            else:
+                output.append("ERROR: message is in '{}' format, not including".format(r.headers['content-type']))
+    except Exception as e:
+        output.append("ERROR: Exception when pinging!")
+    return output
 
 
-def parse_commit_log(do_send_mail, lines):
+def get_object_type(ref):
     """
-    Parse a single commit off the commitlog, which should be in an array
-    of lines, generate a commit message, and send it.
+    Look up the type of the object a ref points to, returned as bytes
+    (b"commit", b"tag" etc). A single git cat-file process is started the
+    first time this is called, and then reused for the rest of the push.
+    """
+    global batchcheck
+
+    if batchcheck is None:
+        batchcheck = Popen(["git", "cat-file", "--batch-check=%(objecttype)"], stdin=PIPE, stdout=PIPE)
+    batchcheck.stdin.write(ref.encode('utf8') + b"\n")
+    batchcheck.stdin.flush()
+    return batchcheck.stdout.readline().strip()
 
-    The order of the array must be reversed.
 
-    The contents of the array will be destroyed.
+def walk_head(headobj, oldobj):
     """
+    Return the set of commits reachable from headobj but not from oldobj.
 
-    if len(lines) == 0:
-        return False
+    Several branches often point at the same commit, and a push of several
+    refs can ask for the same range more than once, so remember the result
+    for the lifetime of the hook instead of running git rev-list again.
+    """
+    if (headobj, oldobj) not in headwalks:
+        headwalks[(headobj, oldobj)] = frozenset(
+            l.decode('ascii') for l in check_output(["git", "rev-list", headobj, "^%s" % oldobj]).splitlines()
+        )
+    return headwalks[(headobj, oldobj)]
+
+
+def get_commit_branches(oldobj, newobj):
+    """
+    Figure out which branches contain each of the commits between oldobj
+    and newobj, returning a dict of commit id -> list of branch names.
+
+    Instead of asking git about every single commit, first find the
+    branches that contain any of the commits at all, and then walk each
+    of those branches once. In the common case of a branch that was just
+    pushed to, its tip is newobj so it contains all of the commits, and
+    it doesn't have to be walked at all.
+    """
+    parents = {}
+    for l in check_output(["git", "rev-list", "--parents", "%s..%s" % (oldobj, newobj)]).splitlines():
+        ids = l.decode('ascii').split()
+        parents[ids[0]] = ids[1:]
+
+    commitbranches = dict((commitid, []) for commitid in parents)
+    if not parents:
+        return commitbranches
+
+    # Any branch containing a commit in the range has to contain at least
+    # one of the commits whose parents are all outside of it.
+    cmd = ["git", "for-each-ref", "--format=%(objectname) %(refname)"]
+    for commitid, commitparents in parents.items():
+        if not any(pp in parents for pp in commitparents):
+            cmd.append("--contains=%s" % commitid)
+    cmd.append(REFS_HEADS)
+    heads = [h.decode('utf8', errors='ignore').strip().split(' ', 1) for h in check_output(cmd).splitlines()]
+
+    for headobj, head in heads:
+        # Clean up the branch name once, and share it between all commits
+        branchname = head[len(REFS_HEADS):]
+        if headobj == newobj:
+            for branches in commitbranches.values():
+                branches.append(branchname)
+            continue
+
+        for commitid in walk_head(headobj, oldobj):
+            if commitid in commitbranches:
+                commitbranches[commitid].append(branchname)
+
+    return commitbranches
+
+
+class LogReader(object):
+    """
+    Read the output of git log one line at a time, allowing a single line
+    to be pushed back so it is returned again by the next read.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.pushback = None
+
+    def readline(self):
+        """
+        Return the next line of the log, or None when it has been exhausted.
+        """
+        if self.pushback is not None:
+            l = self.pushback
+            self.pushback = None
+            return l
+        l = self.f.readline()
+        if not l:
+            return None
+        return l
 
-    # Reset our parsing data
-    commitinfo = ""
-    authorinfo = ""
-    committerinfo = ""
-    mergeinfo = ""
+    def unread(self, l):
+        self.pushback = l
+
+
+def get_branch_archive(branch):
+    """
+    Create a .tar.gz archive of the contents of a branch, and return it
+    base64 encoded, ready to be attached to a mail.
+
+    The tarball is compressed as it is read from git, and spooled to a
+    temporary file, which is then base64 encoded a chunk at a time, so
+    that the only full copy of it kept in memory is the encoded one.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as f:
+        p = Popen(["git", "archive", branch], stdout=PIPE)
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9) as gz:
+            shutil.copyfileobj(p.stdout, gz, 65536)
+        p.stdout.close()
+        p.wait()
+
+        f.seek(0)
+        encoded = io.BytesIO()
+        base64.encode(f, encoded)
+        return str(encoded.getbuffer(), 'ascii')
+
+
+def parse_commit_log(do_send_mail, log, commitbranches):
+    """
+    Parse a single commit off the commitlog, which should be a LogReader
+    wrapping the output of git log in oldest-first order, generate a commit
+    message, and send it. The branches each commit is on are looked up in
+    commitbranches, as returned by get_commit_branches().
+
+    Returns False once there are no more commits in the log.
+    """
+
+    # Collect the values of the header lines, keyed by the header they
+    # start with
+    headers = {}
     while True:
-        l = lines.pop().decode('utf8', errors='ignore').strip()
-        if l == "":
+        l = log.readline()
+        if l is None or l.strip() == b"":
             break
-        elif l.startswith("commit "):
-            commitinfo = l
-        elif l.startswith("Author: "):
-            authorinfo = l
-        elif l.startswith("Commit: "):
-            committerinfo = l
-        elif l.startswith("Merge: "):
-            mergeinfo = l
-        else:
-            raise Exception("Unknown header line: %s" % l)
-
-    if not (commitinfo or authorinfo):
+        m = LOG_HEADER_RE.match(l)
+        if not m:
+            raise Exception("Unknown header line: %s" % l.decode('utf8', errors='ignore').strip())
+        headers[m.group(1)] = m.group(2).decode('utf8', errors='ignore').strip()
+    commitid = headers.get(b"commit", "")
+    author = headers.get(b"Author:", "")
+    committer = headers.get(b"Commit:", "")
+
+    if not (commitid or author):
         # If none of these existed, we must've hit the end of the log
         return False
     # Check for any individual piece that is missing
-    if not commitinfo:
+    if not commitid:
         raise Exception("Could not find commit hash!")
-    if not authorinfo:
+    if not author:
         raise Exception("Could not find author!")
-    if not committerinfo:
+    if not committer:
         raise Exception("Could not find committer!")
 
+    # Read the commit message and the stats in a single pass. We are in the
+    # commit message until we hit one line that doesn't start with four
+    # spaces, and then in the stats section until we hit an empty line.
+    # The lines are kept as bytes here, and decoded once each section
+    # is complete.
     commitmsg = []
-    # We are in the commit message until we hit one line that doesn't start
-    # with four spaces (commit message).
-    while len(lines):
-        l = lines.pop().decode('utf8', errors='ignore')
-        if l.startswith("    "):
-            # Remove the 4 leading spaces and any trailing spaces
-            commitmsg.append(l[4:].rstrip())
-        else:
-            break  # something else means start of stats section
-
     diffstat = []
-    while len(lines):
-        ll = lines.pop()
-        l = ll.decode('utf8', errors='ignore')
-        if l.strip() == "":
+    inmessage = True
+    while True:
+        l = log.readline()
+        if l is None:
             break
-        if not l.startswith(" "):
+        if inmessage:
+            if l.startswith(b"    "):
+                # Remove the 4 leading spaces and any trailing spaces
+                commitmsg.append(l[4:].rstrip())
+            else:
+                inmessage = False  # something else means start of stats section
+            continue
+
+        if l.strip() == b"":
+            break
+        if not l.startswith(b" "):
             # If there is no starting space, it means there were no stats rows,
             # and we're already looking at the next commit. Put this line back
-            # on the list and move on
-            lines.append(ll)
+            # in the log and move on
+            log.unread(l)
             break
         diffstat.append(l.strip())
 
+    if commitmsg:
+        commitmsg = b"\n".join(commitmsg).decode('utf8', errors='ignore').split("\n")
+    diffstat = b"\n".join(diffstat).decode('utf8', errors='ignore')
+
     # Figure out affected branches
-    p = Popen("git branch --contains %s" % commitinfo[7:], shell=True, stdout=PIPE)
-    branches = [b.decode('utf8', errors='ignore').strip(" *\r\n") for b in p.stdout.readlines()]
-    p.stdout.close()
+    branches = commitbranches.get(commitid, [])
     allbranches.extend(branches)
 
     # We have now collected all data. If we're not going to actually send the mail,
@@ -289,67 +528,66 @@ def parse_commit_log(do_send_mail, lines):
     if not do_send_mail:
         return True
 
-    if c.has_option('commitmsg', 'excludebranches'):
-        for branchmatch in branches:
-            if branchmatch in [b.strip() for b in c.get('commitmsg', 'excludebranches').split(',')]:
-                print("Not sending commit message for excluded branch {}".format(branches[0]))
-                return True
+    excluded = EXCLUDEBRANCHES.intersection(branches)
+    if excluded:
+        print("Not sending commit message for excluded branch {}".format(", ".join(sorted(excluded))))
+        return True
 
     # Everything is parsed, put together an email
-    mail = []
-    mail.extend(commitmsg)
-    mail.append("")
-    if c.has_option('commitmsg', 'forcesendername'):
+    mail = io.StringIO()
+    for l in commitmsg:
+        mail.write(l)
+        mail.write("\n")
+    mail.write("\n")
+    if FORCESENDERNAME is not None:
         # If the sender name is changed, put the committer info in the contents
         # of the mail.
-        mail.append("Committer: {}".format(committerinfo[7:]))
-        mail.append("")
+        mail.write("Committer: {}\n\n".format(committer))
     if len(branches) > 1:
-        mail.append("Branches")
-        mail.append("--------")
+        mail.write("Branches\n--------\n")
     else:
-        mail.append("Branch")
-        mail.append("------")
-    mail.append("\n".join(branches))
-    mail.append("")
-    if c.has_option('commitmsg', 'gitweb') or committerinfo[7:] != authorinfo[7:]:
-        mail.append("Details")
-        mail.append("-------")
-        if c.has_option('commitmsg', 'gitweb'):
-            mail.append(
-                c.get('commitmsg', 'gitweb').replace('$action', 'commitdiff').replace('$commit', commitinfo[7:]))
-        if committerinfo[7:] != authorinfo[7:]:
-            mail.append(authorinfo)  # already includes Author: part
-        mail.append("")
-    mail.append("Modified Files")
-    mail.append("--------------")
-    mail.extend(diffstat)
-    mail.append("")
-    mail.append("")
-
-    if c.has_option('commitmsg', 'includediff') and c.get('commitmsg', 'includediff') == '1':
+        mail.write("Branch\n------\n")
+    for b in branches:
+        mail.write(b)
+        mail.write("\n")
+    mail.write("\n")
+    if GITWEB or committer != author:
+        mail.write("Details\n-------\n")
+        if GITWEB:
+            mail.write(GITWEB.safe_substitute(action='commitdiff', commit=commitid))
+            mail.write("\n")
+        if committer != author:
+            mail.write("Author: {}\n".format(author))
+        mail.write("\n")
+    mail.write("Modified Files\n--------------\n")
+    if diffstat:
+        mail.write(diffstat)
+        mail.write("\n")
+    mail.write("\n\n")
+
+    if INCLUDEDIFF:
         # Include the full diff, up to 500 lines.
-        mail.append("Changes")
-        mail.append("--------------")
-        p = Popen("git diff {}^..{}".format(commitinfo[7:], commitinfo[7:]), shell=True, stdout=PIPE)
-        for l in p.stdout.read().splitlines():
-            mail.append(l.decode('utf8', errors='ignore'))
-        p.stdout.close()
-
-    if len(branches) == 1 and c.has_option('commitmsg', 'attacharchive') and c.get('commitmsg', 'attacharchive') == '1':
+        mail.write("Changes\n--------------\n")
+        # Unlike other git failures this one is not fatal, since a root
+        # commit has no parent to diff against.
+        p = Popen(["git", "diff", "{}^..{}".format(commitid, commitid)], stdout=PIPE)
+        diff = p.communicate()[0].splitlines()
+        if diff:
+            # Decode the whole diff at once, rather than line by line
+            mail.write(b"\n".join(diff).decode('utf8', errors='ignore'))
+            mail.write("\n")
+
+    if len(branches) == 1 and ATTACHARCHIVE:
         # Archive the branch to a .tar.gz and send it (this is probably really
         # slow on big archives, but that's not what it's supposed to be used for)
-        p = Popen("git archive %s | gzip -9" % branches[0], shell=True, stdout=PIPE)
-        archive = p.stdout.read()
-        p.stdout.close()
+        archive = get_branch_archive(branches[0])
     else:
         archive = None
 
     sendmail(
-        "\n".join(mail),
-        committerinfo[7:],
-        c.get('commitmsg', 'subject').replace("$shortmsg",
-                                              commitmsg[0][:80 - len(c.get('commitmsg', 'subject'))]),
+        mail.getvalue(),
+        committer,
+        SUBJECT.safe_substitute(shortmsg=commitmsg[0][:80 - len(SUBJECT.template)]),
         archive,
     )
     return True
@@ -357,51 +595,56 @@ def parse_commit_log(do_send_mail, lines):
 
 def parse_annotated_tag(lines):
     """
-    Parse a single commit off the commitlog, which should be in an array
-    of lines, generate a commit message, and send it.
+    Parse the description of an annotated tag, as given by git show, which
+    can be any iterable of lines, generate a tag message, and send it.
 
-    The contents of the array will be destroyed.
+    Only the lines up to the end of the tag message are consumed.
     """
-    if len(lines) == 0:
+    lines = iter(lines)
+
+    l = next(lines, None)
+    if l is None:
         return
 
-    if not lines[0].startswith('tag'):
+    if not l.startswith('tag'):
         raise Exception("Tag message does not start with tag!")
-    tagname = lines[0][4:].strip()
+    tagname = l[4:].strip()
 
-    if not lines[1].startswith('Tagger: '):
+    l = next(lines, '')
+    if not l.startswith('Tagger: '):
         raise Exception("Tag message does not contain tagger!")
-    author = lines[1][8:].strip()
+    author = l[8:].strip()
 
-    if not lines[2].startswith('Date:   '):
+    if not next(lines, '').startswith('Date:   '):
         raise Exception("Tag message does not contain date!")
-    if not lines[3].strip() == "":
+    l = next(lines, None)
+    if l is None or not l.strip() == "":
         raise Exception("Tag message does not contian message separator!")
 
-    mail = []
-    mail.append('Tag %s has been created.' % tagname)
-    mail.append("View: %s" % (
-        c.get('commitmsg', 'gitweb').replace('$action', 'tag').replace('$commit', 'refs/tags/%s' % tagname))
+    mail = io.StringIO()
+    mail.write('Tag %s has been created.\n' % tagname)
+    mail.write("View: %s\n" % (
+        GITWEB.safe_substitute(action='tag', commit=REFS_TAGS + tagname))
     )
-    mail.append("")
-    mail.append("Log Message")
-    mail.append("-----------")
+    mail.write("\n")
+    mail.write("Log Message\n-----------\n")
 
-    for i in range(4, len(lines)):
-        if lines[i].strip() == '':
+    for l in lines:
+        if l.strip() == '':
             break
-        mail.append(lines[i].rstrip())
+        mail.write(l.rstrip())
+        mail.write("\n")
 
     # Ignore the commit it's referring to here
-    sendmail("\n".join(mail),
+    sendmail(mail.getvalue(),
              author,
-             c.get('commitmsg', 'subject').replace('$shortmsg', 'Tag %s has been created.' % tagname))
+             SUBJECT.safe_substitute(shortmsg='Tag %s has been created.' % tagname))
     return
 
 
 if __name__ == "__main__":
     # Get a list of refs on stdin, do something smart with it
-    do_send_mail = c.has_option('commitmsg', 'destination')
+    do_send_mail = bool(DESTINATIONS)
 
     while True:
         l = sys.stdin.readline()
@@ -411,19 +654,19 @@ if __name__ == "__main__":
         (oldobj, newobj, ref) = l.split()
 
         # Build the email
-        if oldobj == "".zfill(40):
+        if oldobj == NULL_SHA:
             # old object being all zeroes means a new branch or tag was created
-            if ref.startswith("refs/heads/"):
+            if ref.startswith(REFS_HEADS):
                 # It's a branch!
                 if not do_send_mail:
                     continue
-                if not should_send_message('branch'):
+                if not SENDMESSAGE['branch']:
                     continue
 
-                branchname = ref.replace('refs/heads/', '')
-                if c.has_option('commitmsg', 'gitweb'):
+                branchname = ref[len(REFS_HEADS):]
+                if GITWEB:
                     gwstr = "View: %s" % (
-                        c.get('commitmsg', 'gitweb').replace('$action', 'shortlog').replace('$commit', ref),
+                        GITWEB.safe_substitute(action='shortlog', commit=ref),
                     )
                 else:
                     gwstr = ""
@@ -431,69 +674,80 @@ if __name__ == "__main__":
                 sendmail(
                     "Branch %s was created.\n\n%s" % (branchname, gwstr),
                     None,
-                    c.get('commitmsg', 'subject').replace("$shortmsg",
-                                                          "Branch %s was created" % branchname)
+                    SUBJECT.safe_substitute(shortmsg="Branch %s was created" % branchname)
                 )
                 allbranches.append(branchname)
-            elif ref.startswith("refs/tags/"):
+            elif ref.startswith(REFS_TAGS):
                 # It's a tag!
                 # It can be either an annotated tag or a lightweight one.
                 if not do_send_mail:
                     continue
-                if not should_send_message('tag'):
+                if not SENDMESSAGE['tag']:
                     continue
 
-                p = Popen("git cat-file -t %s" % ref, shell=True, stdout=PIPE)
-                t = p.stdout.read().strip()
-                p.stdout.close()
+                t = get_object_type(ref)
                 if t == b"commit":
                     # Lightweight tag with no further information
                     sendmail("Tag %s was created.\n" % ref,
                              None,
-                             c.get('commitmsg', 'subject').replace("$shortmsg",
-                                                                   "Tag %s was created" % ref))
+                             SUBJECT.safe_substitute(shortmsg="Tag %s was created" % ref))
                 elif t == b"tag":
                     # Annotated tag! Get the description!
-                    p = Popen("git show %s" % ref, shell=True, stdout=PIPE)
-                    lines = p.stdout.readlines()
-                    p.stdout.close()
-                    parse_annotated_tag([l.decode('utf8', errors='ignore') for l in lines])
+                    lines = check_output(["git", "show", ref]).splitlines()
+                    parse_annotated_tag(l.decode('utf8', errors='ignore') for l in lines)
                 else:
                     raise Exception("Unknown tag type '%s'" % t)
             else:
                 raise Exception("Unknown branch/tag type %s" % ref)
 
-        elif newobj == "".zfill(40):
+        elif newobj == NULL_SHA:
             # new object being all zeroes means a branch was removed
             if not do_send_mail:
                 continue
-            if not should_send_message('branch'):
+            if not SENDMESSAGE['branch']:
                 continue
 
             sendmail("Branch %s was removed." % ref,
                      None,
-                     c.get('commitmsg', 'subject').replace("$shortmsg",
-                                                           "Branch %s was removed" % ref))
+                     SUBJECT.safe_substitute(shortmsg="Branch %s was removed" % ref))
         else:
             # If both are real object ids, we can call git log on them
-            if not should_send_message('commit'):
+            if not SENDMESSAGE['commit']:
                 continue
 
-            cmd = "git log %s..%s --stat --pretty=full" % (oldobj, newobj)
-            p = Popen(cmd, shell=True, stdout=PIPE)
-            lines = p.stdout.readlines()
-            lines.reverse()
-            while parse_commit_log(do_send_mail, lines):
+            if not (do_send_mail or PINGBRANCHES):
+                # Nothing would use the commits, so don't look at them at all
+                continue
+
+            commitbranches = get_commit_branches(oldobj, newobj)
+            if not do_send_mail:
+                # Without mails to send, the commits are only needed to find
+                # the branches to ping, and those are already known.
+                for branches in commitbranches.values():
+                    allbranches.extend(branches)
+                continue
+
+            # Have git list the commits oldest first, so they can be parsed
+            # and mailed in order as the log is read.
+            p = Popen(["git", "log", "%s..%s" % (oldobj, newobj), "--reverse", "--stat", "--pretty=full"], stdout=PIPE)
+            log = LogReader(p.stdout)
+            while parse_commit_log(do_send_mail, log, commitbranches):
                 pass
+            p.stdout.close()
+            p.wait()
+
+    if batchcheck is not None:
+        batchcheck.stdin.close()
+        batchcheck.wait()
 
     flush_mail()
 
     # Send of a http POST ping if there is something changed
-    if c.has_option('commitmsg', 'pingurl'):
+    if PINGURLS:
         pingurls = []
         # First build a list of all the URLs to ping, there could
         # be more than one.
-        for pingurl in c.get('commitmsg', 'pingurl').split(' '):
+        for pingurl in PINGURLS:
             if pingurl.find('$branch') >= 0:
                 # Branch is included, possibly send multiple
                 for b in set(allbranches):
@@ -501,21 +755,10 @@ if __name__ == "__main__":
             else:
                 pingurls.append(pingurl)
 
-        # Then actuall ping them all
-        for pingurl in pingurls:
-            # Make a http POST (the empty content makes it a POST)
-            # We ignore what the result is, so we also ignore any exceptions.
-            try:
-                r = requests.post(pingurl)
-                if r.status_code == 200:
-                    for l in r.text.splitlines():
-                        print("PING: {0}".format(l))
-                else:
-                    print("ERROR: status {0} {1} from ping!".format(r.status_code, r.reason))
-                    if r.headers['content-type'].split(';')[0] == 'text/plain':
-                        for l in r.text.splitlines():
-                            print("ERROR: {0}".format(l))
-                    else:
-                        print("ERROR: message is in '{}' format, not including".format(r.headers['content-type']))
-            except Exception as e:
-                print("ERROR: Exception when pinging!")
+        # Then actually ping them all. The pings are independent of each
+        # other, so send them in parallel, but print the results in order.
+        if pingurls:
+            with ThreadPoolExecutor(max_workers=min(8, len(pingurls))) as executor:
+                for output in executor.map(ping, pingurls):
+                    for l in output:
+                        print(l)
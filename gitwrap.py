@@ -30,12 +30,16 @@ class Logger(object):
     def __init__(self, cfg):
         self.user = "Unknown"
         self.logfile = cfg.get('paths', 'logfile')
+        self.fd = None
 
     def log(self, message):
-        f = open(self.logfile, "a")
-        f.write("%s (%s): %s" % (datetime.datetime.now(), self.user, message))
-        f.write("\n")
-        f.close()
+        # Keep the file open once it has been opened, and write each entry
+        # with a single write on an O_APPEND descriptor, so concurrent
+        # sessions never interleave within a line. The descriptor is not
+        # inheritable, so it is closed when we exec git.
+        if self.fd is None:
+            self.fd = os.open(self.logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        os.write(self.fd, ("%s (%s): %s\n" % (datetime.datetime.now(), self.user, message)).encode('utf8'))
 
     def setuser(self, user):
         if user:
@@ -88,8 +92,12 @@ class PgGit(object):
             raise InternalException("Repository does not exist")
 
     def run_command(self):
-        self.logger.log("Running \"git shell %s %s\"" % (self.command, "'%s'" % self.path))
-        os.execvp('git', ['git', 'shell', '-c', "%s %s" % (self.command, "'%s'" % self.path)])
+        # The command and path have both been validated at this point, so
+        # run the git command directly instead of having git shell parse
+        # them again.
+        subcommand = self.command[len("git-"):]
+        self.logger.log("Running \"git %s '%s'\"" % (subcommand, self.path))
+        os.execvp('git', ['git', subcommand, self.path])
 
     def run(self):
         try:
@@ -110,7 +118,7 @@ class PgGit(object):
                 # If we failed to log, try once more with a new logger, otherwise,
                 # just accept that we failed.
                 try:
-                    Logger().log(e)
+                    Logger(self.cfg).log(e)
                 except:
                     pass
             sys.stderr.write("An unhandled exception occurred on the server\n")
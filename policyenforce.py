@@ -22,9 +22,12 @@
 import sys
 import os.path
 import re
-from subprocess import Popen, PIPE
+import atexit
+import tempfile
+from subprocess import Popen, PIPE, DEVNULL, call
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from configparser import ConfigParser
-import codecs
 
 #
 # Load the global config
@@ -33,7 +36,7 @@ cfgname = "%s/policyenforce.ini" % os.path.dirname(sys.argv[0])
 if not os.path.isfile(cfgname):
     raise Exception("Config file '%s' is missing!" % cfgname)
 c = ConfigParser()
-with codecs.open(cfgname, 'r', encoding='utf8') as f:
+with open(cfgname, 'r', encoding='utf8') as f:
     c.read_file(f)
 
 # Figure out if we should do debugging
@@ -43,19 +46,137 @@ except Exception as e:
     print("Except: %s" % e)
     debug = 1
 
+# The object id git uses to indicate that a ref didn't exist before, or
+# doesn't exist after, the push.
+NULL_SHA = "0" * 40
+
+# Namespaces of the refs for branches and tags
+REFS_HEADS = "refs/heads/"
+REFS_TAGS = "refs/tags/"
+
+# Format of an author/committer record in a commit, and of the
+# "name <email>" part of it
+AUTHOR_RE = re.compile(r'^([^<]+ <[^>]+>) \d+ [+-]\d{4}$')
+USER_RE = re.compile(r'^([^<]+) <([^>]+)>')
+
+# The policies that are simply turned on or off are looked up once, since
+# they are checked again for every single commit. A value that is not a
+# valid boolean refuses the push, rather than guessing what was meant.
+POLICIES = {}
+for policyname in ('nomerge', 'committerequalsauthor', 'committerlist', 'authorlist',
+                   'signcommits', 'signtags', 'nolightweighttag',
+                   'nobranchcreate', 'nobranchdelete'):
+    try:
+        POLICIES[policyname] = c.getboolean('policies', policyname, fallback=False)
+    except ValueError:
+        print("Invalid value '%s' for policy %s, must be a boolean" % (
+            c.get('policies', policyname), policyname))
+        sys.exit(1)
+ANY_COMMIT_POLICY = any(POLICIES[policyname] for policyname in
+                        ('nomerge', 'committerequalsauthor', 'committerlist', 'authorlist', 'signcommits'))
+ANY_TAG_POLICY = POLICIES['nolightweighttag'] or POLICIES['signtags']
+
+# The same goes for the policies that are set to a string, where an empty
+# string means the policy is not enforced.
+POLICY_STRINGS = dict(
+    (policyname, c.get('policies', policyname, fallback='').strip() or None)
+    for policyname in ('branchnamefilter', 'forcepushbranches')
+)
+
+# The registered committers, keyed by their name in lowercase (which is
+# what ConfigParser turns all keys into), with their email as the value.
+if c.has_section('committers'):
+    COMMITTERS = dict(c.items('committers'))
+else:
+    COMMITTERS = {}
+
+# The environment to run gpg in when verifying signatures, pointing it at
+# the configured keyring. Only looked up if signatures are actually checked.
+if POLICIES['signcommits'] or POLICIES['signtags']:
+    GPG_ENV = dict(os.environ, GNUPGHOME=c.get('policyenforce', 'gpghome'))
+else:
+    GPG_ENV = None
+
+# If a keyring is configured, commit signatures are checked by running gpgv
+# against it directly, instead of going through git and a full gpg. gpgv
+# runs in the same environment as gpg, so a keyring given without a path
+# is looked up in gpghome.
+GPGV_KEYRING = c.get('policyenforce', 'gpgkeyring', fallback='').strip() or None
+
+
+@lru_cache(maxsize=8)
+def policy_regex(pattern):
+    """
+    Compile a regular expression given in one of the policies. The
+    compiled expression is kept, so each pattern is only compiled once.
+    """
+    return re.compile(pattern)
+
+
+def read_batch_object(f):
+    """
+    Read one object from the output of git cat-file --batch, returning
+    a tuple of its id, its type and its raw contents as bytes, or None
+    once the output is exhausted.
+    """
+    l = f.readline()
+    if not l:
+        return None
+
+    # The header is "<objectid> <type> <size>", or "<objectid> missing".
+    # The id and type are plain ASCII, and the size can be parsed straight
+    # from the bytes.
+    header = l.split()
+    if len(header) != 3:
+        raise Exception("Object %s could not be read" % header[0].decode('utf8', errors='ignore'))
+    size = int(header[2])
+    # The contents are followed by a newline, that's not part of them
+    data = f.read(size + 1)
+    return (header[0].decode('ascii'), header[1].decode('ascii'), data[:size])
+
+
+class CatFile(object):
+    """
+    This class wraps a single git cat-file --batch process, which is used to
+    read all the objects that are needed instead of starting a new git
+    process for each of them. The process is started the first time an
+    object is requested, and stopped when the script exits.
+    """
+    def __init__(self):
+        self.p = None
+
+    def get(self, objectid):
+        """
+        Read an object from the repository, returning a tuple of the type
+        of the object and its raw contents as bytes.
+        """
+        if self.p is None:
+            self.p = Popen(["git", "cat-file", "--batch"], stdin=PIPE, stdout=PIPE)
+            atexit.register(self.close)
+        self.p.stdin.write(objectid.encode('utf8') + b"\n")
+        self.p.stdin.flush()
+
+        obj = read_batch_object(self.p.stdout)
+        if obj is None:
+            raise Exception("Object %s could not be read" % objectid)
+        return obj[1:]
+
+    def close(self):
+        if self.p is not None:
+            self.p.stdin.close()
+            self.p.wait()
+            self.p = None
+
+
+catfile = CatFile()
+
 
 class PolicyObject(object):
     def _enforce(self, policyname):
         """
         Check if a specific policy should be enforced, returning True/False
         """
-        try:
-            enf = int(c.get("policies", policyname))
-            if enf == 1:
-                return True
-            return False
-        except Exception as e:
-            return False
+        return POLICIES[policyname]
 
     def _enforce_str(self, policyname):
         """
@@ -63,50 +184,59 @@ class PolicyObject(object):
         containing the value of the policy, or None if the policy is not
         specified or empty.
         """
-        try:
-            enf = c.get("policies", policyname).strip()
-            if enf == "":
-                return None
-            return enf
-        except Exception as e:
-            return None
+        return POLICY_STRINGS[policyname]
 
 
 class Commit(PolicyObject):
     """
     This class wraps a single commit, and the checking of policies on it.
     """
-    def __init__(self, commitid):
+    def __init__(self, commitid, data=None):
         """
         Initialize and load basic information about a commit. Takes the SHA-1
         of a commit as parameter (should in theory work with other types of
-        references as well).
+        references as well), and optionally the raw commit object if it has
+        already been read.
         """
         self.commitid = commitid
+        self.data = None
         self.tree = None
         self.parent = []
         self.author = None
         self.committer = None
-
-        # Get the basic info about the commit using git cat-file
-        p = Popen("git cat-file commit %s" % commitid, shell=True, stdout=PIPE)
-        for l in p.stdout:
-            l = l.decode('utf8', errors='ignore')
-            if re.match(r'^(\s+)$', l):
-                break
-            elif l.startswith("tree "):
-                self.tree = l[5:].strip()
-            elif l.startswith("parent "):
-                self.parent.append(l[7:].strip())
-            elif l.startswith("author "):
-                self.author = self._parse_author(l[7:].strip())
-            elif l.startswith("committer "):
-                self.committer = self._parse_author(l[10:].strip())
-            elif l.startswith("gpgsig "):
+        self.signature = None
+
+        # Get the basic info about the commit from the shared git cat-file,
+        # unless we already have it
+        if data is None:
+            objtype, data = catfile.get(commitid)
+            if objtype != "commit":
+                raise Exception("Object %s is a %s, not a commit" % (commitid, objtype))
+        # The raw object is only needed later if its signature is going to
+        # be checked with gpgv, so don't keep it around for every commit in
+        # the push otherwise.
+        if POLICIES['signcommits'] and GPGV_KEYRING:
+            self.data = data
+        # The headers end at the first empty line, and only the values that
+        # are actually used are decoded.
+        headers = data.partition(b"\n\n")[0]
+        for l in headers.split(b"\n"):
+            if l.startswith(b" "):
+                # Continuation of a multi-line header, such as gpgsig
+                pass
+            elif l.startswith(b"tree "):
+                self.tree = l[5:].decode('utf8', errors='ignore').strip()
+            elif l.startswith(b"parent "):
+                self.parent.append(l[7:].decode('utf8', errors='ignore').strip())
+            elif l.startswith(b"author "):
+                self.author = self._parse_author(l[7:].decode('utf8', errors='ignore').strip())
+            elif l.startswith(b"committer "):
+                self.committer = self._parse_author(l[10:].decode('utf8', errors='ignore').strip())
+            elif l.startswith(b"gpgsig "):
                 pass
             else:
-                raise Exception("Unknown commit info line for commit %s: %s" % (commitid, l))
-        p.stdout.close()
+                raise Exception("Unknown commit info line for commit %s: %s" % (
+                    commitid, l.decode('utf8', errors='ignore')))
 
         # Verify that the basic information we retrieved is complete.
         if not self.tree:
@@ -118,6 +248,37 @@ class Commit(PolicyObject):
         if not self.committer:
             raise Exception("Commit %s has no committer" % commitid)
 
+    @classmethod
+    def load_range(cls, oldobj, newobj):
+        """
+        Load all commits between oldobj and newobj, in the order given by
+        git rev-list. The output of git rev-list is fed straight into a git
+        cat-file --batch of its own, so only two processes are needed no
+        matter how many commits there are. Since nothing waits for the
+        answer to each request, cat-file can buffer its output instead of
+        flushing it after every object.
+        """
+        rev = Popen(["git", "rev-list", "%s..%s" % (oldobj, newobj)], stdin=DEVNULL, stdout=PIPE)
+        cat = Popen(["git", "cat-file", "--batch", "--buffer"], stdin=rev.stdout, stdout=PIPE)
+        # cat-file has its own copy of the pipe now, so it sees end of file
+        # once rev-list exits.
+        rev.stdout.close()
+
+        commits = []
+        while True:
+            obj = read_batch_object(cat.stdout)
+            if obj is None:
+                break
+            commitid, objtype, data = obj
+            if objtype != "commit":
+                raise Exception("Object %s is a %s, not a commit" % (commitid, objtype))
+            commits.append(cls(commitid, data))
+        cat.stdout.close()
+
+        if rev.wait() != 0 or cat.wait() != 0:
+            raise Exception("Failed to load commits %s..%s" % (oldobj, newobj))
+        return commits
+
     def _parse_author(self, authorstring):
         """
         Parse an author record from a git object. Expects the format
@@ -125,11 +286,108 @@ class Commit(PolicyObject):
 
         Returns the "name <email>" part.
         """
-        m = re.search(r'^([^<]+ <[^>]+>) \d+ [+-]\d{4}$', authorstring)
+        m = AUTHOR_RE.match(authorstring)
         if not m:
             raise Exception("User '%s' on commit %s does not follow format rules." % (authorstring, self.commitid))
         return m.group(1)
 
+    def _split_signature(self):
+        """
+        Split the raw commit object into the payload that is signed, which
+        is the object without its gpgsig header, and the signature itself.
+        Returns None for the signature if the commit isn't signed.
+        """
+        headers, sep, body = self.data.partition(b"\n\n")
+        payload = []
+        signature = []
+        insignature = False
+        for l in headers.split(b"\n"):
+            if l.startswith(b"gpgsig "):
+                insignature = True
+                signature.append(l[7:])
+            elif insignature and l.startswith(b" "):
+                signature.append(l[1:])
+            else:
+                insignature = False
+                payload.append(l)
+        if not signature:
+            return (self.data, None)
+        return (b"\n".join(payload) + sep + body, b"\n".join(signature) + b"\n")
+
+    def verify_signature(self):
+        """
+        Verify the GPG signature of the commit, and store the line where gpg
+        reports a good signature in self.signature, or an empty string if
+        the commit is not signed by a trusted key. This doesn't enforce or
+        print anything, so it can be run for several commits in parallel.
+        """
+        if GPGV_KEYRING:
+            self._verify_signature_gpgv()
+            return
+
+        p = Popen(["git", "verify-commit", self.commitid], stdin=DEVNULL, stderr=PIPE, env=GPG_ENV)
+        for l in p.communicate()[1].decode('utf8', errors='ignore').splitlines():
+            if l.startswith('gpg: Good signature from'):
+                self.signature = l
+                break
+        else:
+            self.signature = ""
+
+    def _verify_signature_gpgv(self):
+        """
+        Verify the GPG signature of the commit with gpgv and the configured
+        keyring, using the raw commit object that has already been read.
+        """
+        payload, signature = self._split_signature()
+        if signature is None:
+            # Not signed at all, so there is nothing to run gpgv on
+            self.signature = ""
+            return
+
+        # gpgv can only read one of the signature and the signed data from
+        # stdin, so the signature goes in a file of its own.
+        with tempfile.NamedTemporaryFile(prefix='policyenforce') as sigfile:
+            sigfile.write(signature)
+            sigfile.flush()
+            p = Popen(["gpgv", "--keyring", GPGV_KEYRING, sigfile.name, "-"],
+                      stdin=PIPE, stdout=DEVNULL, stderr=PIPE, env=GPG_ENV)
+            err = p.communicate(payload)[1]
+        if p.returncode == 0:
+            for l in err.decode('utf8', errors='ignore').splitlines():
+                if l.startswith('gpgv: Good signature from'):
+                    self.signature = l
+                    return
+        self.signature = ""
+
+    @staticmethod
+    def verify_signatures(commits):
+        """
+        Verify the GPG signatures of a list of commits, running a single git
+        verify-commit for many commits at a time instead of one per commit.
+
+        gpg doesn't say which commit each line of output is about, so this
+        is only conclusive when every commit comes back with a good
+        signature, and then the signatures are stored on the commits.
+        Returns True if all of them could be verified this way, otherwise
+        the commits whose signatures are still unknown have to be verified
+        one by one with verify_signature().
+        """
+        allgood = True
+        # Verify in batches, to stay well clear of the limit on the length
+        # of a command line.
+        for i in range(0, len(commits), 500):
+            batch = commits[i:i + 500]
+            p = Popen(["git", "verify-commit"] + [commit.commitid for commit in batch],
+                      stdin=DEVNULL, stderr=PIPE, env=GPG_ENV)
+            good = [l for l in p.communicate()[1].decode('utf8', errors='ignore').splitlines()
+                    if l.startswith('gpg: Good signature from')]
+            if p.returncode == 0 and len(good) == len(batch):
+                for commit, signature in zip(batch, good):
+                    commit.signature = signature
+            else:
+                allgood = False
+        return allgood
+
     def _policyfail(self, msg):
         """
         Indicate that a commit violated a policy, and abort the program with the
@@ -143,6 +401,8 @@ class Commit(PolicyObject):
         For this commit, check all policies that are enabled in the configuration
         file.
         """
+        if not ANY_COMMIT_POLICY:
+            return
 
         if self._enforce("nomerge"):
             # Merge commits always have more than one parent
@@ -162,30 +422,28 @@ class Commit(PolicyObject):
             self.enforce_user(self.author, 'Author')
 
         if self._enforce("signcommits"):
-            # Enforce that all commits are signed
-            e = os.environ.copy()
-            e['GNUPGHOME'] = c.get('policyenforce', 'gpghome')
-            p = Popen("git verify-commit %s" % self.commitid, shell=True, stderr=PIPE, env=e)
-            for l in p.stderr:
-                if l.startswith('gpg: Good signature from'):
-                    if debug:
-                        print("Signature verified: %s" % l)
-                    break
-            else:
+            # Enforce that all commits are signed. Unless the signature
+            # has already been verified, do it now.
+            if self.signature is None:
+                self.verify_signature()
+            if not self.signature:
                 self._policyfail("Commit is not signed by a trusted key")
+            if debug:
+                print("Signature verified: %s" % self.signature)
 
     def enforce_user(self, user, usertype):
         # We do this by splitting the name again, and doing a lookup
         # match on that.
-        m = re.search('^([^<]+) <([^>]+)>', user)
+        m = USER_RE.match(user)
         if not m:
             raise Exception("%s '%s' for commit %s does not follow format rules." % (usertype, user, self.commitid))
-        uname = str(m.group(1)).lower()
-        if not c.has_option('committers', uname):
+        uname = m.group(1).lower()
+        email = COMMITTERS.get(uname)
+        if email is None:
             self._policyfail("%s %s not listed in committers section" % (usertype, uname))
-        if not c.get('committers', uname) == m.group(2):
+        if email != m.group(2):
             self._policyfail("%s %s has wrong email (%s, should be %s)" % (
-                usertype, uname, m.group(2), c.get('committers', uname)))
+                usertype, uname, m.group(2), email))
 
 
 class Tag(PolicyObject):
@@ -194,21 +452,20 @@ class Tag(PolicyObject):
         self.name = name
 
     def check_policies(self):
+        if not ANY_TAG_POLICY:
+            return
+
         if self._enforce("nolightweighttag"):
-            # A lightweight tag is a tag object, a "heavy" tag is
-            # a commit object.
-            p = Popen("git cat-file -t %s" % self.ref, shell=True, stdout=PIPE)
-            t = p.stdout.read().strip()
-            p.stdout.close()
+            # A lightweight tag points directly at a commit object, a
+            # "heavy" (annotated) tag is a tag object.
+            t = catfile.get(self.ref)[0]
             if t == "commit":
                 self._policyfail("No lightweight tags allowed")
 
         if self._enforce("signtags"):
             # Enforce that all tags are signed
-            e = os.environ.copy()
-            e['GNUPGHOME'] = c.get('policyenforce', 'gpghome')
-            p = Popen("git verify-tag %s" % self.ref, shell=True, stderr=PIPE, env=e)
-            for l in p.stderr:
+            p = Popen(["git", "verify-tag", self.ref], stdin=DEVNULL, stderr=PIPE, env=GPG_ENV)
+            for l in p.communicate()[1].decode('utf8', errors='ignore').splitlines():
                 if l.startswith('gpg: Good signature from'):
                     if debug:
                         print("Signature verified: %s" % l)
@@ -233,11 +490,11 @@ class Branch(PolicyObject):
     def check_create(self):
         if self._enforce("nobranchcreate"):
             self._policyfail("No branch creation allowed")
-        if self._enforce_str("branchnamefilter"):
+        branchnamefilter = self._enforce_str("branchnamefilter")
+        if branchnamefilter:
             # All branch names starts with refs/heads/, so just remove that
             # when doing the regexp match
-            if not re.match(self._enforce_str("branchnamefilter"),
-                            self.name[len("refs/heads/"):]):
+            if not policy_regex(branchnamefilter).match(self.name[len(REFS_HEADS):]):
                 self._policyfail("Branch name does not match allowed regexp")
 
     def check_remove(self):
@@ -265,16 +522,18 @@ class ForcePush(PolicyObject):
             # If not configured, then all branches are accepted
             return
 
-        for p in patterns.split(','):
-            if re.fullmatch(p, self.name[len("refs/heads/"):]):
-                return
+        # Each pattern is matched on its own, since flags and group numbers
+        # in one of them would not survive being combined with the others.
+        branchname = self.name[len(REFS_HEADS):]
+        if any(policy_regex(p).fullmatch(branchname) for p in patterns.split(',')):
+            return
 
         # With no match on the branch name that means that *if* this is a force-push, we should
-        # reject it. So figure out if it is.
-        p = Popen("git merge-base {} {}".format(self.old, self.new), shell=True, stdout=PIPE)
-        merge = p.stdout.read().decode('utf8', 'ignore').strip()
-        if merge != self.old:
-            print("Forced pushes are not allowed on branch {}".format(self.name[len("refs/heads/"):]))
+        # reject it. So figure out if it is, which is the case unless the old
+        # commit is an ancestor of the new one. git only has to answer with
+        # its exit code, which is also nonzero if it fails.
+        if call(["git", "merge-base", "--is-ancestor", self.old, self.new], stdin=DEVNULL) != 0:
+            print("Forced pushes are not allowed on branch {}".format(self.name[len(REFS_HEADS):]))
             sys.exit(1)
 
 
@@ -284,18 +543,18 @@ if __name__ == "__main__":
     oldobj = sys.argv[2]
     newobj = sys.argv[3]
 
-    if oldobj == "".zfill(40):
+    if oldobj == NULL_SHA:
         # old object being all zeroes means a new branch or tag was created
-        if ref.startswith("refs/heads/"):
+        if ref.startswith(REFS_HEADS):
             # It's a branch!
             Branch(newobj, ref).check_create()
-        elif ref.startswith("refs/tags/"):
+        elif ref.startswith(REFS_TAGS):
             # It's a tag!
             Tag(newobj, ref).check_policies()
         else:
             raise Exception("Unknown branch/tag type %s" % ref)
 
-    elif newobj == "".zfill(40):
+    elif newobj == NULL_SHA:
         # new object being all zeroes means a branch was removed
         Branch(newobj, ref).check_remove()
     else:
@@ -304,14 +563,43 @@ if __name__ == "__main__":
         ForcePush(ref, oldobj, newobj).check_force()
 
         # Now use git rev-list to identify exactly which ones they are,
-        # and apply policies as needed.
-        p = Popen("git rev-list %s..%s" % (oldobj, newobj), shell=True, stdout=PIPE)
-        for l in p.stdout:
-            if debug:
-                print("Checking commit %s" % l.decode('utf8', errors='ignore').strip())
-            Commit(l.decode('utf8', errors='ignore').strip()).check_policies()
-            if debug:
-                print("Commit ok.")
+        # and apply policies as needed. In debugging mode the push is
+        # refused anyway, so if there are no policies to report on for
+        # the commits, don't even look at them.
+        if debug and not ANY_COMMIT_POLICY:
+            commits = []
+        else:
+            commits = Commit.load_range(oldobj, newobj)
+
+        # Running gpg is by far the most expensive part of checking a
+        # commit, so try to verify all the signatures with a single call
+        # first. If any of them fails, find out which one by verifying
+        # the commits that are still unknown on their own, in parallel.
+        # With a keyring configured each commit is verified with gpgv,
+        # which is cheap enough to go straight to doing them in parallel.
+        # The policies are still checked one commit at a time and in order
+        # below, and the verifications not yet started are cancelled on the
+        # first failure.
+        verifier = None
+        verified = {}
+        if commits and POLICIES['signcommits'] and (GPGV_KEYRING or not Commit.verify_signatures(commits)):
+            verifier = ThreadPoolExecutor(max_workers=min(8, len(commits)))
+            for commit in commits:
+                if commit.signature is None:
+                    verified[commit.commitid] = verifier.submit(commit.verify_signature)
+
+        try:
+            for commit in commits:
+                if debug:
+                    print("Checking commit %s" % commit.commitid)
+                if commit.commitid in verified:
+                    verified[commit.commitid].result()
+                commit.check_policies()
+                if debug:
+                    print("Commit ok.")
+        finally:
+            if verifier is not None:
+                verifier.shutdown(cancel_futures=True)
 
     if debug:
         print("In debugging mode, refusing push unconditionally.")